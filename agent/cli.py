@@ -17,9 +17,6 @@ import sys
 import threading
 from pathlib import Path
 
-import uvicorn
-
-from .server import create_app
 from .frp import FRPClient, get_frpc_path, download_frpc
 
 
@@ -67,6 +64,10 @@ def main():
     setup_logging(args.debug)
     logger = logging.getLogger("claude-remote")
 
+    # 参数解析完成后再导入 uvicorn/FastAPI，--help 等不需要承担导入开销
+    import uvicorn
+    from .server import RemoteServer, create_app
+
     # 创建 FastAPI 应用
     app = create_app(
         workspace=args.workspace,
@@ -119,15 +120,28 @@ def main():
 
     signal.signal(signal.SIGINT, cleanup)
     signal.signal(signal.SIGTERM, cleanup)
+    # frpc 运行在独立会话中，关闭终端时收不到 SIGHUP，需要由本进程负责停止；
+    # 转成 SIGTERM，服务运行中由 uvicorn 正常关闭后在 finally 停止 frpc，之前则直接 cleanup
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: signal.raise_signal(signal.SIGTERM))
 
     # 启动 HTTP 服务
     try:
-        uvicorn.run(
+        server = RemoteServer(uvicorn.Config(
             app,
             host=args.host,
             port=args.port,
             log_level="info" if not args.debug else "debug",
-        )
+            # SSE 流收到退出通知后会自行结束；宽限期只兜底卡住的连接，避免退出卡住
+            timeout_graceful_shutdown=5,
+        ))
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+        if not server.started:
+            # 与 uvicorn.run 一致：启动失败（如端口被占用）时以非零状态退出
+            sys.exit(3)
     finally:
         if frp_client:
             frp_client.stop()
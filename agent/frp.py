@@ -4,22 +4,38 @@ FRP 客户端管理
 自动下载、配置和启动 frpc，建立到公网服务器的隧道
 """
 
+import functools
 import hashlib
 import json
 import logging
 import os
 import platform
+import queue
+import secrets
 import shutil
 import signal
 import subprocess
 import sys
-import tempfile
+import threading
 import urllib.request
 from pathlib import Path
 from typing import Optional
 
 logger = logging.getLogger("claude-remote")
 
+# 运行期间不变的平台信息，导入时读取一次
+_SYSTEM = platform.system()
+_MACHINE = platform.machine().lower()
+_NODE = platform.node().lower()
+
+# 各平台的应用数据目录
+if _SYSTEM == "Darwin":
+    _APP_BASE = Path.home() / "Library" / "Application Support"
+elif _SYSTEM == "Windows":
+    _APP_BASE = Path(os.environ.get("APPDATA", Path.home()))
+else:
+    _APP_BASE = Path.home() / ".local" / "share"
+
 # FRP 版本
 FRP_VERSION = "0.61.1"
 
@@ -29,22 +45,39 @@ FRP_DOWNLOAD_URL = (
     "frp_{version}_{os}_{arch}.tar.gz"
 )
 
+# 官方发布的压缩包 SHA256 校验文件
+FRP_CHECKSUMS_URL = (
+    "https://github.com/fatedier/frp/releases/download/v{version}/"
+    "frp_sha256_checksums.txt"
+)
+
+# 下载与解压的读写块大小
+_DOWNLOAD_CHUNK = 1024 * 1024
 
+
+@functools.lru_cache(maxsize=1)
 def get_frp_dir() -> Path:
-    """获取 FRP 安装目录"""
-    if platform.system() == "Darwin":
-        base = Path.home() / "Library" / "Application Support"
-    elif platform.system() == "Windows":
-        base = Path(os.environ.get("APPDATA", Path.home()))
-    else:
-        base = Path.home() / ".local" / "share"
-    d = base / "ClaudeCodeRemote" / "frp"
+    """获取 FRP 安装目录（首次调用时创建，结果缓存）"""
+    d = _APP_BASE / "ClaudeCodeRemote" / "frp"
     d.mkdir(parents=True, exist_ok=True)
     return d
 
 
+# 上次找到的 frpc 路径，文件仍存在时直接复用
+_FRPC_PATH_CACHE: Optional[str] = None
+
+
 def get_frpc_path() -> Optional[str]:
-    """获取 frpc 可执行文件路径
+    """获取 frpc 可执行文件路径（结果缓存，下载后通过 _invalidate_frpc_cache 刷新）"""
+    global _FRPC_PATH_CACHE
+    if _FRPC_PATH_CACHE and os.path.exists(_FRPC_PATH_CACHE):
+        return _FRPC_PATH_CACHE
+    _FRPC_PATH_CACHE = _find_frpc()
+    return _FRPC_PATH_CACHE
+
+
+def _find_frpc() -> Optional[str]:
+    """查找 frpc 可执行文件
     
     查找顺序：
     1. 应用内置资源（打包后）
@@ -78,10 +111,16 @@ def get_frpc_path() -> Optional[str]:
     return None
 
 
+def _invalidate_frpc_cache():
+    """清除 get_frpc_path 的缓存结果"""
+    global _FRPC_PATH_CACHE
+    _FRPC_PATH_CACHE = None
+
+
 def _get_platform_info():
     """获取当前平台信息（用于下载）"""
-    system = platform.system().lower()
-    machine = platform.machine().lower()
+    system = _SYSTEM.lower()
+    machine = _MACHINE
 
     os_name = {"darwin": "darwin", "linux": "linux", "windows": "windows"}.get(
         system, system
@@ -97,6 +136,89 @@ def _get_platform_info():
     return os_name, arch
 
 
+class _DownloadReader:
+    """包装下载响应：边读边计算 SHA256，并按已读字节数每 10% 回调一次进度"""
+
+    def __init__(self, resp, total: int, callback=None):
+        self._resp = resp
+        self._total = total
+        self._callback = callback
+        self._read = 0
+        self._reported = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._resp.read(size)
+        self.sha256.update(data)
+        self._read += len(data)
+        if self._callback and self._total:
+            percent = min(100, self._read * 100 // self._total) // 10 * 10
+            if percent > self._reported:
+                self._reported = percent
+                self._callback(f"正在下载 frpc... {percent}%")
+        return data
+
+
+def _fetch_expected_sha256(filename: str) -> Optional[str]:
+    """从官方校验文件中查找压缩包的 SHA256，获取不到时返回 None"""
+    url = FRP_CHECKSUMS_URL.format(version=FRP_VERSION)
+    try:
+        with urllib.request.urlopen(url, timeout=15) as resp:
+            text = resp.read().decode("utf-8", errors="replace")
+    except Exception as e:
+        logger.warning(f"获取 frp 校验文件失败，跳过压缩包校验: {e}")
+        return None
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == filename:
+            return parts[0].lower()
+    logger.warning(f"校验文件中没有 {filename}，跳过压缩包校验")
+    return None
+
+
+def _frpc_cache_path(url: str) -> Path:
+    """下载缓存路径，以下载地址为键（版本或平台变化即对应不同缓存）"""
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return get_frp_dir() / f"frpc-{key}"
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_DOWNLOAD_CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _install_frpc(src: Path, dst: Path):
+    """从缓存安装 frpc，同一文件系统上用硬链接，否则复制"""
+    if src == dst:
+        return
+    tmp_path = dst.with_name(dst.name + ".part")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+    os.chmod(dst, 0o755)
+
+
+def _restore_cached_frpc(cache_path: Path, frpc_path: Path) -> bool:
+    """缓存文件存在且 SHA256 与记录一致时直接安装，无需联网"""
+    sentinel = cache_path.with_name(cache_path.name + ".sha256")
+    try:
+        expected = sentinel.read_text(encoding="utf-8").strip()
+        if _file_sha256(cache_path) != expected:
+            logger.warning(f"frpc 缓存校验失败，重新下载: {cache_path}")
+            return False
+        _install_frpc(cache_path, frpc_path)
+    except OSError:
+        return False
+    return True
+
+
 def download_frpc(progress_callback=None) -> Optional[str]:
     """下载 frpc 到本地（如果尚未安装）"""
     # 先检查是否已有 frpc
@@ -119,35 +241,61 @@ def download_frpc(progress_callback=None) -> Optional[str]:
     
     frpc_path = frp_dir / "frpc"
 
+    # 之前下载过同一版本时直接从缓存恢复
+    cache_path = _frpc_cache_path(url)
+    if _restore_cached_frpc(cache_path, frpc_path):
+        _invalidate_frpc_cache()
+        logger.info(f"frpc 已从缓存恢复: {frpc_path}")
+        return str(frpc_path)
+
     logger.info(f"首次运行，正在下载 frpc v{FRP_VERSION}...")
     logger.info(f"下载地址: {url}")
     logger.info(f"保存位置: {frpc_path}")
     if progress_callback:
         progress_callback(f"首次运行，正在下载 frpc...")
 
+    part_path = cache_path.with_name(cache_path.name + ".part")
     try:
-        # 下载到临时文件
-        with tempfile.NamedTemporaryFile(suffix=".tar.gz", delete=False) as tmp:
-            tmp_path = tmp.name
-            urllib.request.urlretrieve(url, tmp_path)
-
-        # 解压
+        # 边下载边解压（流式 r|gz 模式），不落地临时压缩包
         import tarfile
-        with tarfile.open(tmp_path, "r:gz") as tar:
-            # 查找 frpc 文件（在子目录中）
-            for member in tar.getmembers():
-                if member.name.endswith("/frpc") or member.name == "frpc":
-                    # 提取文件内容
-                    f = tar.extractfile(member)
-                    if f:
-                        frpc_path.write_bytes(f.read())
+        expected = _fetch_expected_sha256(url.rsplit("/", 1)[-1])
+        digest = hashlib.sha256()
+        with urllib.request.urlopen(url) as resp:
+            total = int(resp.headers.get("Content-Length") or 0)
+            source = _DownloadReader(resp, total, progress_callback)
+            with tarfile.open(fileobj=source, mode="r|gz", bufsize=_DOWNLOAD_CHUNK) as tar:
+                # 查找 frpc 文件（在子目录中），找到即停止，不再解压后续成员
+                found = False
+                for member in tar:
+                    if member.isfile() and os.path.basename(member.name) == "frpc":
+                        f = tar.extractfile(member)
+                        # 写入的同时计算 SHA256，作为缓存校验记录
+                        with open(part_path, "wb") as out:
+                            for block in iter(lambda: f.read(_DOWNLOAD_CHUNK), b""):
+                                digest.update(block)
+                                out.write(block)
+                        found = True
                         break
-
-        # 删除临时文件
-        os.unlink(tmp_path)
-
-        # 设置可执行权限
-        os.chmod(frpc_path, 0o755)
+                # 释放已解析的成员头信息
+                tar.members = []
+            if expected:
+                # 读完剩余部分，压缩包的哈希在下载过程中同步计算，无需再读一遍
+                while source.read(_DOWNLOAD_CHUNK):
+                    pass
+                if source.sha256.hexdigest() != expected:
+                    raise RuntimeError("frpc 压缩包 SHA256 校验失败")
+                logger.info("frpc 压缩包 SHA256 校验通过")
+        if not found:
+            raise RuntimeError("压缩包中未找到 frpc")
+
+        # 写完后再替换，避免留下不完整的可执行文件
+        os.replace(part_path, cache_path)
+        os.chmod(cache_path, 0o755)
+        cache_path.with_name(cache_path.name + ".sha256").write_text(
+            digest.hexdigest(), encoding="utf-8"
+        )
+        _install_frpc(cache_path, frpc_path)
+        _invalidate_frpc_cache()
         logger.info(f"frpc 已安装: {frpc_path}")
 
         if progress_callback:
@@ -156,12 +304,27 @@ def download_frpc(progress_callback=None) -> Optional[str]:
         return str(frpc_path)
         
     except Exception as e:
+        if part_path.exists():
+            part_path.unlink()
         logger.error(f"下载 frpc 失败: {e}")
         if progress_callback:
             progress_callback(f"下载失败: {e}")
         return None
 
 
+def _put_drop_oldest(q: queue.Queue, item):
+    """放入队列，队列已满时丢弃最旧的一项"""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
 class FRPClient:
     """FRP 客户端管理器"""
 
@@ -178,44 +341,50 @@ class FRPClient:
         self.auth_token = auth_token
         self.agent_id = agent_id or self._gen_agent_id()
         self.local_port = local_port
+        self._subdomain = self.agent_id
+        self._public_url = f"http://{self._subdomain}.{self.server_addr}"
         self.process: Optional[subprocess.Popen] = None
         self._config_path: Optional[str] = None
+        self._log_queue: queue.Queue = queue.Queue(maxsize=1024)
+        self._reader: Optional[threading.Thread] = None
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def _gen_agent_id() -> str:
-        """生成唯一 agent ID"""
-        hostname = platform.node().lower().replace(".", "-")
-        # 取机器信息的哈希前6位
-        uid = hashlib.md5(
-            f"{hostname}-{os.getuid()}".encode()
-        ).hexdigest()[:6]
+        """生成唯一 agent ID（同一台机器上不变，只计算一次）"""
+        hostname = _NODE.replace(".", "-")
+        # Windows 没有 getuid，用用户名区分
+        user = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "")
+        # 机器信息的 3 字节哈希，正好 6 位十六进制
+        uid = hashlib.blake2b(
+            f"{hostname}-{user}".encode(), digest_size=3
+        ).hexdigest()
         return f"{hostname}-{uid}"
 
     @property
     def public_url(self) -> str:
-        """获取公网访问地址"""
-        subdomain = getattr(self, '_subdomain', self.agent_id)
-        return f"http://{subdomain}.{self.server_addr}"
+        """获取公网访问地址（生成配置时计算一次）"""
+        return self._public_url
 
     def _write_config(self) -> str:
         """生成 frpc 配置文件"""
-        # 使用时间戳确保代理名称和子域名唯一，避免 "proxy already exists" 和 "router config conflict" 错误
-        import time
-        proxy_suffix = hex(int(time.time()) & 0xFFFF)[2:]  # 取时间戳后4位十六进制
+        # 使用随机后缀确保代理名称和子域名唯一，避免 "proxy already exists" 和 "router config conflict" 错误
+        proxy_suffix = secrets.token_hex(3)
         proxy_name = f"claude-{self.agent_id}-{proxy_suffix}"
         # 子域名也需要唯一，否则会出现 router config conflict
         self._subdomain = f"{self.agent_id}-{proxy_suffix}"
-        
-        config = f"""serverAddr = "{self.server_addr}"
-serverPort = {self.server_port}
-"""
-        if self.auth_token:
-            config += f"""
+        self._public_url = f"http://{self._subdomain}.{self.server_addr}"
+
+        auth_block = f"""
 auth.method = "token"
 auth.token = "{self.auth_token}"
-"""
+""" if self.auth_token else ""
 
-        config += f"""
+        config = f"""serverAddr = "{self.server_addr}"
+serverPort = {self.server_port}
+log.to = "console"
+log.level = "info"
+{auth_block}
 [[proxies]]
 name = "{proxy_name}"
 type = "http"
@@ -225,7 +394,10 @@ customDomains = ["{self._subdomain}.{self.server_addr}"]
 
         config_dir = get_frp_dir()
         config_path = config_dir / "frpc.toml"
-        config_path.write_text(config, encoding="utf-8")
+        # 先写临时文件再原子替换，frpc 不会读到写了一半的配置
+        tmp_path = config_path.with_name(config_path.name + ".tmp")
+        tmp_path.write_text(config, encoding="utf-8")
+        os.replace(tmp_path, config_path)
         self._config_path = str(config_path)
         logger.info(f"FRP 配置: {config_path}")
         logger.info(f"代理名称: {proxy_name}")
@@ -252,50 +424,69 @@ customDomains = ["{self._subdomain}.{self.server_addr}"]
         logger.info(f"Agent ID: {self.agent_id}")
 
         try:
+            # 放到独立进程组，停止时可以连同 frpc 的子进程一起结束
+            if os.name == "nt":
+                group_kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+            else:
+                group_kwargs = {"start_new_session": True}
             self.process = subprocess.Popen(
                 [frpc, "-c", config_path],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
+                # 输出由读取线程直接按块读取 fd 并自行解码，不需要文本包装
+                bufsize=0,
+                **group_kwargs,
             )
             logger.info(f"frpc 进程已启动 (PID: {self.process.pid})")
+            # 后台线程阻塞读取输出并放入队列，启动检测直接等待队列
+            self._log_queue = queue.Queue(maxsize=1024)
+            self._reader = threading.Thread(
+                target=self._reader_thread,
+                args=(self.process.stdout.fileno(), self._log_queue),
+                daemon=True,
+            )
+            self._reader.start()
             
             # 等待并检查启动状态
             import time
-            start_time = time.time()
+            deadline = time.time() + timeout
             connected = False
             error_msg = None
+            unreported = []
             
-            while time.time() - start_time < timeout:
-                # 检查进程是否异常退出
-                if self.process.poll() is not None:
-                    # 进程已退出，读取所有输出
-                    remaining = self.process.stdout.read() if self.process.stdout else ""
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    line = self._log_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+                if line is None:
+                    # 输出已结束，进程异常退出
+                    try:
+                        self.process.wait(timeout=1)
+                    except subprocess.TimeoutExpired:
+                        pass
                     logger.error(f"frpc 进程异常退出，退出码: {self.process.returncode}")
-                    if remaining:
-                        for line in remaining.strip().split("\n"):
-                            logger.error(f"  frpc: {line}")
+                    for line in unreported:
+                        logger.error(f"  frpc: {line}")
                     return False
-                
-                # 尝试读取输出
-                line = self._read_line_nonblock()
-                if line:
-                    line = line.strip()
-                    if line:
-                        # 记录 frpc 输出
-                        if "error" in line.lower() or "failed" in line.lower():
-                            logger.warning(f"frpc: {line}")
-                            error_msg = line
-                        elif "start proxy success" in line.lower():
-                            logger.info(f"frpc: {line}")
-                            connected = True
-                            break
-                        elif "login to server success" in line.lower():
-                            logger.info(f"frpc: {line}")
-                        else:
-                            logger.debug(f"frpc: {line}")
+
+                # 记录 frpc 输出
+                if "error" in line.lower() or "failed" in line.lower():
+                    logger.warning(f"frpc: {line}")
+                    error_msg = line
+                elif "start proxy success" in line.lower():
+                    logger.info(f"frpc: {line}")
+                    connected = True
+                    break
+                elif "login to server success" in line.lower():
+                    logger.info(f"frpc: {line}")
                 else:
-                    time.sleep(0.1)
+                    logger.debug(f"frpc: {line}")
+                    unreported.append(line)
             
             if connected:
                 logger.info(f"FRP 隧道连接成功: {self.public_url}")
@@ -317,17 +508,36 @@ customDomains = ["{self._subdomain}.{self.server_addr}"]
             logger.error(f"启动 frpc 失败: {e}")
             return False
 
-    def _read_line_nonblock(self) -> Optional[str]:
-        """非阻塞读取一行输出"""
-        if self.process and self.process.stdout:
+    @staticmethod
+    def _reader_thread(fd: int, out: queue.Queue):
+        """读取 frpc 输出直到管道关闭，按行（已去除首尾空白）放入队列，结束时放入 None
+
+        一次最多读 64KB，完整的行整块解码后再切分；队列满时丢弃最旧的行，
+        避免无人消费时阻塞读取、进而让 frpc 写日志时卡住。
+        """
+        buf = bytearray()
+        while True:
             try:
-                import select as sel
-                ready, _, _ = sel.select([self.process.stdout], [], [], 0)
-                if ready:
-                    return self.process.stdout.readline()
-            except (OSError, ValueError):
-                pass
-        return None
+                data = os.read(fd, 65536)
+            except OSError:
+                data = b""
+            if data:
+                buf += data
+            elif buf:
+                # 管道已关闭，补上最后不完整的一行
+                buf += b"\n"
+            end = buf.rfind(b"\n")
+            if end >= 0:
+                chunk = buf[:end].decode("utf-8", errors="replace")
+                del buf[:end + 1]
+                for line in chunk.split("\n"):
+                    # 去掉首尾空白（含 Windows 的 \r），空行不占队列
+                    line = line.strip()
+                    if line:
+                        _put_drop_oldest(out, line)
+            if not data:
+                break
+        _put_drop_oldest(out, None)
 
     def stop(self):
         """停止 FRP 客户端"""
@@ -335,16 +545,19 @@ customDomains = ["{self._subdomain}.{self.server_addr}"]
             logger.info("正在停止 frpc...")
             try:
                 # 先尝试优雅关闭
-                self.process.send_signal(signal.SIGTERM)
+                self._signal_group()
                 self.process.wait(timeout=5)
             except subprocess.TimeoutExpired:
                 logger.warning("frpc 未能在5秒内退出，强制终止")
-                self.process.kill()
+                self._signal_group(force=True)
                 self.process.wait(timeout=2)
             except OSError as e:
                 logger.warning(f"停止 frpc 时出错: {e}")
             finally:
-                # 关闭 stdout 管道
+                # 等读取线程收到 EOF 后再关闭 stdout 管道，避免其读到复用的 fd
+                if self._reader:
+                    self._reader.join(timeout=1)
+                    self._reader = None
                 if self.process.stdout:
                     try:
                         self.process.stdout.close()
@@ -364,18 +577,27 @@ customDomains = ["{self._subdomain}.{self.server_addr}"]
                 logger.debug(f"删除配置文件失败: {e}")
             self._config_path = None
 
+    def _signal_group(self, force: bool = False):
+        """结束 frpc 所在的整个进程组，force 时强制杀死"""
+        if os.name == "nt":
+            if force:
+                self.process.kill()
+            else:
+                self.process.send_signal(signal.CTRL_BREAK_EVENT)
+            return
+        try:
+            # start_new_session 下进程组 ID 等于 frpc 的 PID
+            os.killpg(self.process.pid, signal.SIGKILL if force else signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
     def is_running(self) -> bool:
         """检查 FRP 是否在运行"""
         return self.process is not None and self.process.poll() is None
 
     def read_output(self) -> Optional[str]:
         """读取 frpc 输出（非阻塞）"""
-        if self.process and self.process.stdout:
-            try:
-                import select as sel
-                ready, _, _ = sel.select([self.process.stdout], [], [], 0)
-                if ready:
-                    return self.process.stdout.readline()
-            except (OSError, ValueError):
-                pass
-        return None
+        try:
+            return self._log_queue.get_nowait()
+        except queue.Empty:
+            return None
@@ -8,52 +8,87 @@ Claude Code Remote - GUI 客户端
 """
 
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import json
 import logging
 import os
 import platform
+import re
 import secrets
 import sys
 import threading
+import time
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import ttk, messagebox, scrolledtext, filedialog
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
-import uvicorn
+if TYPE_CHECKING:
+    import uvicorn
+    from agent.frp import FRPClient
 
-# 导入本地模块
-try:
-    from agent.server import create_app
-    from agent.frp import FRPClient, download_frpc
-except ImportError:
-    from server import create_app
-    from frp import FRPClient, download_frpc
+
+# 本地模块延迟到首次使用时导入：server 依赖 FastAPI/uvicorn，导入要数百毫秒，
+# 放在模块顶部会推迟窗口的首次显示
+def _server_module():
+    try:
+        from agent import server
+    except ImportError:
+        import server
+    return server
+
+
+def _frp_module():
+    try:
+        from agent import frp
+    except ImportError:
+        import frp
+    return frp
 
 
 # ============================================================================
 # 配置管理
 # ============================================================================
 
+# 运行期间不变的平台信息，导入时读取一次
+_SYSTEM = platform.system()
+
+# 各平台的配置目录
+if _SYSTEM == "Windows":
+    _CONFIG_BASE = Path(os.environ.get("APPDATA", Path.home()))
+elif _SYSTEM == "Darwin":
+    _CONFIG_BASE = Path.home() / "Library" / "Application Support"
+else:
+    _CONFIG_BASE = Path.home() / ".config"
+_CONFIG_DIR = _CONFIG_BASE / "ClaudeCodeRemote"
+_CONFIG_FILE = _CONFIG_DIR / "config.json"
+
+
+@functools.lru_cache(maxsize=1)
 def get_config_dir() -> Path:
-    if platform.system() == "Windows":
-        base = Path(os.environ.get("APPDATA", Path.home()))
-    elif platform.system() == "Darwin":
-        base = Path.home() / "Library" / "Application Support"
-    else:
-        base = Path.home() / ".config"
-    d = base / "ClaudeCodeRemote"
-    d.mkdir(parents=True, exist_ok=True)
-    return d
+    _CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    return _CONFIG_DIR
 
 
 def get_config_file() -> Path:
-    return get_config_dir() / "config.json"
+    get_config_dir()
+    return _CONFIG_FILE
+
+
+# 后台保存可能与主线程保存并发，串行化对同一临时文件的写入
+_CONFIG_WRITE_LOCK = threading.Lock()
 
 
 class AppConfig:
     """应用配置"""
+    # 固定字段，load 时配置文件里的未知键也不会变成新属性
+    __slots__ = ("frp_server", "frp_port", "frp_token", "local_port",
+                 "workspace", "claude_path", "agent_id", "_last_written", "_pending_text")
+
     def __init__(self):
         self.frp_server = "taskbot.com.cn"
         self.frp_port = 7000
@@ -62,20 +97,27 @@ class AppConfig:
         self.workspace = str(Path.home())
         self.claude_path = ""
         self.agent_id = ""
+        # 最近一次读到或写入的文件内容，内容相同时 save 跳过写盘
+        self._last_written: Optional[str] = None
+        # 最新一次 save 要写入的内容；写盘线程只写这一份，较早的快照不会覆盖较新的
+        self._pending_text: Optional[str] = None
         self.load()
 
     def load(self):
         f = get_config_file()
         if f.exists():
             try:
-                data = json.loads(f.read_text("utf-8"))
+                text = f.read_text("utf-8")
+                data = json.loads(text)
                 for k, v in data.items():
                     if hasattr(self, k):
                         setattr(self, k, v)
+                self._last_written = text
             except Exception:
                 pass
 
-    def save(self):
+    def save(self, background: bool = False):
+        """保存配置；background=True 时在后台线程写盘，不阻塞界面"""
         data = {
             "frp_server": self.frp_server,
             "frp_port": self.frp_port,
@@ -85,10 +127,29 @@ class AppConfig:
             "claude_path": self.claude_path,
             "agent_id": self.agent_id,
         }
-        try:
-            get_config_file().write_text(json.dumps(data, indent=2, ensure_ascii=False), "utf-8")
-        except Exception as e:
-            print(f"保存配置失败: {e}")
+        text = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        if text == self._last_written:
+            return
+        self._pending_text = text
+        if background:
+            threading.Thread(target=self._write, daemon=True).start()
+        else:
+            self._write()
+
+    def _write(self):
+        with _CONFIG_WRITE_LOCK:
+            text = self._pending_text
+            if text is None or text == self._last_written:
+                return
+            try:
+                # 先写临时文件再替换，写到一半崩溃也不会留下残缺的配置
+                f = get_config_file()
+                tmp = f.with_name(f.name + ".tmp")
+                tmp.write_bytes(text.encode("utf-8"))
+                os.replace(tmp, f)
+                self._last_written = text
+            except Exception as e:
+                print(f"保存配置失败: {e}")
 
 
 # ============================================================================
@@ -108,6 +169,76 @@ COLORS = {
     'error': '#C62828',
 }
 
+# ttk 样式：(样式名, configure 参数)，导入时构建一次
+STYLE_SPEC = (
+    ('TFrame', {'background': COLORS['bg']}),
+    ('TLabelframe', {'background': COLORS['bg']}),
+    ('TLabelframe.Label', {'background': COLORS['bg'], 'foreground': COLORS['accent'],
+                           'font': ('', 12, 'bold')}),
+    ('TLabel', {'background': COLORS['bg'], 'foreground': COLORS['text'], 'font': ('', 11)}),
+    ('TEntry', {'fieldbackground': COLORS['bg_light'], 'foreground': COLORS['text'],
+                'borderwidth': 2, 'relief': 'solid'}),
+    ('TButton', {'background': COLORS['accent_light'], 'foreground': COLORS['text'],
+                 'borderwidth': 0, 'focuscolor': 'none',
+                 'font': ('', 10), 'padding': (10, 5)}),
+    ('Accent.TButton', {'background': COLORS['accent'], 'foreground': 'white',
+                        'borderwidth': 0, 'focuscolor': 'none',
+                        'font': ('', 12, 'bold'), 'padding': (12, 6)}),
+    ('Stop.TButton', {'background': COLORS['error'], 'foreground': 'white',
+                      'borderwidth': 0, 'focuscolor': 'none',
+                      'font': ('', 12, 'bold'), 'padding': (12, 6)}),
+    ('Small.TButton', {'background': COLORS['bg_dark'], 'foreground': COLORS['text'],
+                       'font': ('', 9), 'padding': (6, 3)}),
+)
+
+# ttk 样式的状态映射：(样式名, map 参数)
+STYLE_MAP_SPEC = (
+    ('TButton', {'background': [('active', COLORS['accent_hover']),
+                                ('pressed', COLORS['accent'])],
+                 'foreground': [('active', 'white')]}),
+    ('Accent.TButton', {'background': [('active', COLORS['accent_hover']),
+                                       ('pressed', '#A0522D')]}),
+    ('Stop.TButton', {'background': [('active', '#D32F2F'),
+                                     ('pressed', '#B71C1C')]}),
+)
+
+# 设置对话框中的简单字段：(配置项, 标签, 提示, 整数默认值；None 表示文本)
+SETTING_FIELDS = (
+    ("frp_server", "FRP 服务器:", "远程服务器域名，如 taskbot.com.cn", None),
+    ("frp_port", "FRP 端口:", "FRP 服务端口，默认 7000", 7000),
+    ("frp_token", "FRP 令牌:", "服务器认证令牌（从服务端获取）", None),
+    ("local_port", "本地端口:", "本地 HTTP 服务端口，默认 8080", 8080),
+)
+
+# 日志批量刷新间隔（毫秒）：有日志时用最短间隔，空闲时逐步放慢到上限
+LOG_FLUSH_INTERVAL = 50
+LOG_FLUSH_INTERVAL_IDLE = 500
+# HTTP 服务器停止参数（秒）：uvicorn 等待连接关闭的宽限期；
+# GUI 等待服务协程结束的上限需覆盖宽限期、关闭钩子和 Claude 进程最长 1 秒的退出等待
+SERVER_SHUTDOWN_GRACE = 2
+SERVER_STOP_TIMEOUT = SERVER_SHUTDOWN_GRACE + 4
+
+# 界面上的配置修改延迟保存（毫秒），期间的多次修改合并为一次写盘
+CONFIG_SAVE_DELAY = 500
+# 日志框保留的行数；超出 LOG_TRIM_SLACK 行后才一次性删回 LOG_MAX_LINES 行，
+# 避免到达上限后每次刷新都删几行
+LOG_MAX_LINES = 5000
+LOG_TRIM_SLACK = 500
+
+# 日志着色规则：分组名即标签名，分组序号即优先级（error > success > highlight）
+LOG_TAG_RE = re.compile(
+    r"(?P<error>ERROR|失败|错误)|(?P<success>成功|已启动|已建立)|(?P<highlight>token=|====)"
+)
+# 按分组序号查标签，序号 0 表示未匹配
+LOG_TAGS = ('info',) + tuple(LOG_TAG_RE.groupindex)
+
+
+def _classify(message: str) -> str:
+    """按着色规则返回日志行的标签，多条规则命中时取优先级最高的"""
+    return LOG_TAGS[min(
+        (m.lastindex for m in LOG_TAG_RE.finditer(message)), default=0
+    )]
+
 
 class AgentGUI:
     def __init__(self):
@@ -119,81 +250,52 @@ class AgentGUI:
 
         self.config = AppConfig()
         self.is_running = False
-        self.server_thread: Optional[threading.Thread] = None
-        self.uvicorn_server: Optional[uvicorn.Server] = None
-        self.frp_client: Optional[FRPClient] = None
+        self._serve_future: Optional[concurrent.futures.Future] = None
+        self.uvicorn_server: Optional["uvicorn.Server"] = None
+        self.frp_client: Optional["FRPClient"] = None
         self.access_token: Optional[str] = None
-        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.local_url: Optional[str] = None
+        self.remote_url: Optional[str] = None
+        # 常驻事件循环：多次启动/停止服务复用同一个循环和线程
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self._stopping = False
+        self._close_after_stop = False
+        # 界面当前显示的运行状态，状态未变时不重复配置状态标签和复制按钮
+        self._ui_running = False
+        self._settings_win: Optional[tk.Toplevel] = None
+        self._setting_vars: dict = {}
+        self._save_after: Optional[str] = None
+        # 待写入日志框的 (文本, 标签)，由主线程定时批量刷新
+        self._log_buf: collections.deque = collections.deque()
+        # 日志框当前的行数
+        self._log_lines = 0
+        self._pump_interval = LOG_FLUSH_INTERVAL
 
         self._setup_styles()
         self._setup_ui()
+        self.root.after(LOG_FLUSH_INTERVAL, self._pump_log)
 
     def _setup_styles(self):
         style = ttk.Style()
         style.theme_use('clam')
-
-        style.configure('TFrame', background=COLORS['bg'])
-        style.configure('TLabelframe', background=COLORS['bg'])
-        style.configure('TLabelframe.Label',
-                        background=COLORS['bg'],
-                        foreground=COLORS['accent'],
-                        font=('', 12, 'bold'))
-        style.configure('TLabel',
-                        background=COLORS['bg'],
-                        foreground=COLORS['text'],
-                        font=('', 11))
-        style.configure('TEntry',
-                        fieldbackground=COLORS['bg_light'],
-                        foreground=COLORS['text'],
-                        borderwidth=2, relief='solid')
-
-        style.configure('TButton',
-                        background=COLORS['accent_light'],
-                        foreground=COLORS['text'],
-                        borderwidth=0, focuscolor='none',
-                        font=('', 10), padding=(10, 5))
-        style.map('TButton',
-                  background=[('active', COLORS['accent_hover']),
-                              ('pressed', COLORS['accent'])],
-                  foreground=[('active', 'white')])
-
-        style.configure('Accent.TButton',
-                        background=COLORS['accent'],
-                        foreground='white',
-                        borderwidth=0, focuscolor='none',
-                        font=('', 12, 'bold'), padding=(12, 6))
-        style.map('Accent.TButton',
-                  background=[('active', COLORS['accent_hover']),
-                              ('pressed', '#A0522D')])
-
-        style.configure('Stop.TButton',
-                        background=COLORS['error'],
-                        foreground='white',
-                        borderwidth=0, focuscolor='none',
-                        font=('', 12, 'bold'), padding=(12, 6))
-        style.map('Stop.TButton',
-                  background=[('active', '#D32F2F'),
-                              ('pressed', '#B71C1C')])
-
-        style.configure('Small.TButton',
-                        background=COLORS['bg_dark'],
-                        foreground=COLORS['text'],
-                        font=('', 9), padding=(6, 3))
+        for name, options in STYLE_SPEC:
+            style.configure(name, **options)
+        for name, states in STYLE_MAP_SPEC:
+            style.map(name, **states)
 
     def _setup_ui(self):
+        """先创建首屏必需的控件，其余控件等窗口显示后在空闲时补上"""
         main = ttk.Frame(self.root, padding="15")
         main.pack(fill=tk.BOTH, expand=True)
 
         # --- 标题栏 ---
-        header = ttk.Frame(main)
-        header.pack(fill=tk.X, pady=(0, 12))
+        self._header = ttk.Frame(main)
+        self._header.pack(fill=tk.X, pady=(0, 12))
 
-        tk.Label(header, text="Claude Code Remote",
+        tk.Label(self._header, text="Claude Code Remote",
                  font=('', 22, 'bold'), fg=COLORS['accent'], bg=COLORS['bg']).pack(side=tk.LEFT)
 
-        ttk.Button(header, text="设置", command=self._show_settings,
-                   style='Small.TButton').pack(side=tk.RIGHT, padx=5)
-
         # --- 工作目录 ---
         ws_frame = ttk.Frame(main)
         ws_frame.pack(fill=tk.X, pady=(0, 10))
@@ -209,8 +311,28 @@ class AgentGUI:
         btn_frame = ttk.Frame(main)
         btn_frame.pack(fill=tk.X, pady=(5, 12))
 
-        self.start_btn = ttk.Button(btn_frame, text="启动服务",
-                                     command=self._toggle_service, style='Accent.TButton')
+        # 启动/停止切换频繁，用 tk.Button 直接改颜色，省去 ttk 样式重算；
+        # macOS 原生按钮不支持背景色，仍用 ttk 样式
+        if _SYSTEM == "Darwin":
+            self.start_btn = ttk.Button(btn_frame, text="启动服务",
+                                         command=self._toggle_service, style='Accent.TButton')
+            self._start_btn_looks = {
+                False: {'text': "启动服务", 'style': 'Accent.TButton'},
+                True: {'text': "停止服务", 'style': 'Stop.TButton'},
+            }
+        else:
+            self.start_btn = tk.Button(btn_frame, text="启动服务", command=self._toggle_service,
+                                       bg=COLORS['accent'], fg='white',
+                                       activebackground=COLORS['accent_hover'],
+                                       activeforeground='white', disabledforeground=COLORS['bg_dark'],
+                                       font=('', 12, 'bold'), bd=0, padx=12, pady=6,
+                                       relief=tk.FLAT)
+            self._start_btn_looks = {
+                False: {'text': "启动服务", 'bg': COLORS['accent'],
+                        'activebackground': COLORS['accent_hover']},
+                True: {'text': "停止服务", 'bg': COLORS['error'],
+                       'activebackground': '#D32F2F'},
+            }
         self.start_btn.pack(side=tk.LEFT)
 
         self.status_label = tk.Label(btn_frame, text="未运行",
@@ -218,25 +340,36 @@ class AgentGUI:
         self.status_label.pack(side=tk.LEFT, padx=(15, 0))
 
         # --- 日志区域 ---
-        log_frame = ttk.LabelFrame(main, text=" 运行日志 ", padding="10")
-        log_frame.pack(fill=tk.BOTH, expand=True)
+        self._log_frame = ttk.LabelFrame(main, text=" 运行日志 ", padding="10")
+        self._log_frame.pack(fill=tk.BOTH, expand=True)
 
+        # 日志字体建成命名字体，Tk 只解析一次字体族并缓存度量
+        self._log_font = tkfont.Font(self.root, family="Menlo", size=11, name="LogFont")
+        self._log_font_bold = tkfont.Font(self.root, family="Menlo", size=11, weight="bold",
+                                          name="LogFontBold")
         self.log_text = scrolledtext.ScrolledText(
-            log_frame, height=15, state=tk.DISABLED,
-            font=("Menlo", 11),
+            self._log_frame, height=15, state=tk.DISABLED,
+            font=self._log_font,
             bg=COLORS['bg_light'], fg=COLORS['text'],
             relief='solid', borderwidth=1,
             insertbackground=COLORS['text'])
         self.log_text.pack(fill=tk.BOTH, expand=True)
 
+        self.root.after_idle(self._setup_ui_extras)
+
+    def _setup_ui_extras(self):
+        """非首屏必需的控件：设置按钮、日志颜色和底部操作按钮"""
+        ttk.Button(self._header, text="设置", command=self._show_settings,
+                   style='Small.TButton').pack(side=tk.RIGHT, padx=5)
+
         self.log_text.tag_configure('info', foreground=COLORS['text'])
         self.log_text.tag_configure('success', foreground=COLORS['success'])
         self.log_text.tag_configure('error', foreground=COLORS['error'])
         self.log_text.tag_configure('highlight', foreground=COLORS['accent'],
-                                     font=('Menlo', 11, 'bold'))
+                                     font=self._log_font_bold)
 
         # 底部操作
-        bottom = ttk.Frame(log_frame)
+        bottom = ttk.Frame(self._log_frame)
         bottom.pack(fill=tk.X, pady=(8, 0))
         ttk.Button(bottom, text="清空日志", command=self._clear_log,
                    style='Small.TButton').pack(side=tk.LEFT)
@@ -250,13 +383,30 @@ class AgentGUI:
             self.workspace_var.set(path)
 
     def _show_settings(self):
+        # 对话框只创建一次，之后关闭时隐藏、再次打开时刷新数值后显示
+        win = self._settings_win
+        if win is not None and win.winfo_exists():
+            for key, var in self._setting_vars.items():
+                var.set(str(getattr(self.config, key)))
+            win.deiconify()
+            win.lift()
+            win.grab_set()
+            return
+
         win = tk.Toplevel(self.root)
+        self._settings_win = win
         win.title("设置")
         win.geometry("500x500")
         win.configure(bg=COLORS['bg'])
         win.transient(self.root)
         win.grab_set()
 
+        def close():
+            win.grab_release()
+            win.withdraw()
+
+        win.protocol("WM_DELETE_WINDOW", close)
+
         frame = ttk.Frame(win, padding="15")
         frame.pack(fill=tk.BOTH, expand=True)
 
@@ -284,14 +434,8 @@ class AgentGUI:
             return row + 3
 
         row = 0
-        row = add_field(row, "FRP 服务器:", "frp_server",
-                        "远程服务器域名，如 taskbot.com.cn")
-        row = add_field(row, "FRP 端口:", "frp_port",
-                        "FRP 服务端口，默认 7000")
-        row = add_field(row, "FRP 令牌:", "frp_token",
-                        "服务器认证令牌（从服务端获取）")
-        row = add_field(row, "本地端口:", "local_port",
-                        "本地 HTTP 服务端口，默认 8080")
+        for key, label, hint, _ in SETTING_FIELDS:
+            row = add_field(row, label, key, hint)
 
         # Claude CLI 路径 - 带检测按钮
         ttk.Label(frame, text="Claude CLI 路径:", font=('', 10, 'bold')).grid(
@@ -311,35 +455,17 @@ class AgentGUI:
         entries["claude_path"] = entry
 
         def detect_claude():
-            """检测 Claude CLI 路径"""
-            import shutil
-            from pathlib import Path
-            
-            paths_to_check = [
-                Path.home() / ".local" / "bin" / "claude",
-                Path("/usr/local/bin/claude"),
-                Path("/opt/homebrew/bin/claude"),
-                Path.home() / ".npm-global" / "bin" / "claude",
-            ]
-            
-            # 先检查 PATH
-            found = shutil.which("claude")
-            if found:
-                var.set(found)
-                messagebox.showinfo("检测成功", f"已找到 Claude CLI:\n{found}")
+            """检测 Claude CLI 路径（与启动服务时使用同一套查找逻辑）"""
+            try:
+                found = _server_module().find_claude()
+            except FileNotFoundError:
+                messagebox.showwarning("未找到", 
+                    "未找到 Claude CLI。\n\n"
+                    "请先安装:\nnpm install -g @anthropic-ai/claude-code\n\n"
+                    "或手动输入路径。")
                 return
-            
-            # 检查常见路径
-            for p in paths_to_check:
-                if p.exists() and os.access(p, os.X_OK):
-                    var.set(str(p))
-                    messagebox.showinfo("检测成功", f"已找到 Claude CLI:\n{p}")
-                    return
-            
-            messagebox.showwarning("未找到", 
-                "未找到 Claude CLI。\n\n"
-                "请先安装:\nnpm install -g @anthropic-ai/claude-code\n\n"
-                "或手动输入路径。")
+            var.set(found)
+            messagebox.showinfo("检测成功", f"已找到 Claude CLI:\n{found}")
 
         ttk.Button(claude_frame, text="检测", command=detect_claude,
                    style='Small.TButton').pack(side=tk.LEFT, padx=(5, 0))
@@ -352,26 +478,39 @@ class AgentGUI:
 
         def save():
             try:
-                self.config.frp_server = self._setting_vars["frp_server"].get().strip()
-                self.config.frp_port = int(self._setting_vars["frp_port"].get().strip() or "7000")
-                self.config.frp_token = self._setting_vars["frp_token"].get().strip()
-                self.config.local_port = int(self._setting_vars["local_port"].get().strip() or "8080")
-                self.config.claude_path = self._setting_vars["claude_path"].get().strip()
-                self.config.save()
-                self.log("设置已保存")
-                win.destroy()
+                # 全部解析成功后再写入配置，避免只保存了一半
+                values = {}
+                for key, _, _, default in SETTING_FIELDS:
+                    text = self._setting_vars[key].get().strip()
+                    values[key] = int(text or default) if default is not None else text
+                values["claude_path"] = self._setting_vars["claude_path"].get().strip()
             except ValueError as e:
                 messagebox.showerror("错误", f"端口必须是数字: {e}")
+                return
+            for key, value in values.items():
+                setattr(self.config, key, value)
+            self._save_config()
+            self.log("设置已保存")
+            close()
 
         btn_frame = ttk.Frame(frame)
         btn_frame.grid(row=row, column=0, columnspan=2, pady=(10, 0))
         ttk.Button(btn_frame, text="保存", command=save,
                    style='Accent.TButton').pack(side=tk.LEFT, padx=5)
-        ttk.Button(btn_frame, text="取消", command=win.destroy,
+        ttk.Button(btn_frame, text="取消", command=close,
                    style='Small.TButton').pack(side=tk.LEFT, padx=5)
 
         frame.columnconfigure(0, weight=1)
 
+    def _save_config(self):
+        """延迟保存配置，短时间内的多次调用只写一次盘"""
+        if self._save_after is None:
+            self._save_after = self.root.after(CONFIG_SAVE_DELAY, self._flush_config)
+
+    def _flush_config(self):
+        self._save_after = None
+        self.config.save(background=True)
+
     def _toggle_service(self):
         if self.is_running:
             self._stop_service()
@@ -389,74 +528,84 @@ class AgentGUI:
             return
 
         self.config.workspace = workspace
-        self.config.save()
+        self._save_config()
 
         self.log("正在启动服务...")
         self.start_btn.configure(text="正在启动...", state="disabled")
 
-        def run_server():
-            try:
-                # 生成访问令牌
-                self.access_token = secrets.token_urlsafe(16)
-
-                # 创建 FastAPI 应用
-                self.log("创建服务器...")
-                app = create_app(
-                    workspace=workspace,
-                    claude_path=self.config.claude_path or None,
-                    access_token=self.access_token,
-                )
-
-                # 配置 uvicorn
-                config = uvicorn.Config(
-                    app,
-                    host="127.0.0.1",
-                    port=self.config.local_port,
-                    log_level="warning",
-                )
-                self.uvicorn_server = uvicorn.Server(config)
-
-                # 创建事件循环
-                self.loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(self.loop)
-
-                self.is_running = True
-                self.root.after(0, lambda: self._update_ui_running(True))
-
-                # 显示本地地址
-                local_url = f"http://localhost:{self.config.local_port}?token={self.access_token}"
-                self.root.after(0, lambda: self.log(""))
-                self.root.after(0, lambda: self.log("=" * 50))
-                self.root.after(0, lambda: self.log(f"  本地地址: {local_url}"))
-
-                # 启动 FRP 隧道（在后台线程中，不阻塞）
-                if self.config.frp_server:
-                    threading.Thread(target=self._start_frp, daemon=True).start()
-
-                self.root.after(0, lambda: self.log("=" * 50))
-                self.root.after(0, lambda: self.log(""))
-
-                # 运行服务器（阻塞）
-                self.loop.run_until_complete(self.uvicorn_server.serve())
-
-            except FileNotFoundError as e:
-                self.root.after(0, lambda: self.log(f"错误: {e}", "error"))
-            except OSError as e:
-                if "Address already in use" in str(e):
-                    self.root.after(0, lambda: self.log(f"错误: 端口 {self.config.local_port} 已被占用", "error"))
-                else:
-                    self.root.after(0, lambda: self.log(f"错误: {e}", "error"))
-            except Exception as e:
-                self.root.after(0, lambda: self.log(f"启动失败: {e}", "error"))
-            finally:
-                self.is_running = False
-                self.root.after(0, lambda: self._update_ui_running(False))
-                if self.loop:
-                    self.loop.close()
-                    self.loop = None
+        # 生成访问令牌
+        self.access_token = secrets.token_urlsafe(16)
+        self._serve_future = asyncio.run_coroutine_threadsafe(
+            self._serve(workspace), self.loop
+        )
+
+    async def _serve(self, workspace: str):
+        """在常驻事件循环中创建并运行 HTTP 服务器，直到服务器退出"""
+        app = None
+        try:
+            # 创建 FastAPI 应用
+            self.log("创建服务器...")
+            import uvicorn
+            app = _server_module().create_app(
+                workspace=workspace,
+                claude_path=self.config.claude_path or None,
+                access_token=self.access_token,
+            )
+
+            # 配置 uvicorn
+            config = uvicorn.Config(
+                app,
+                host="127.0.0.1",
+                port=self.config.local_port,
+                log_level="warning",
+                # SSE 长连接不会自行结束，超时后由 uvicorn 取消，避免停止卡住
+                timeout_graceful_shutdown=SERVER_SHUTDOWN_GRACE,
+            )
+            self.uvicorn_server = uvicorn.Server(config)
 
-        self.server_thread = threading.Thread(target=run_server, daemon=True)
-        self.server_thread.start()
+            self.is_running = True
+            self.root.after(0, lambda: self._update_ui_running(True))
+
+            # 显示本地地址
+            self.local_url = f"http://localhost:{self.config.local_port}?token={self.access_token}"
+            self.log("")
+            self.log("=" * 50)
+            self.log(f"  本地地址: {self.local_url}")
+
+            # 启动 FRP 隧道（在后台线程中，不阻塞）
+            if self.config.frp_server:
+                threading.Thread(target=self._start_frp, daemon=True).start()
+
+            self.log("=" * 50)
+            self.log("")
+
+            # 运行服务器，直到退出
+            await self.uvicorn_server.serve()
+
+        except FileNotFoundError as e:
+            self.log(f"错误: {e}", "error")
+        except OSError as e:
+            if "Address already in use" in str(e):
+                self.log(f"错误: 端口 {self.config.local_port} 已被占用", "error")
+            else:
+                self.log(f"错误: {e}", "error")
+        except SystemExit:
+            # uvicorn 绑定端口等启动失败时会调用 sys.exit，不能让它结束常驻事件循环
+            self.log("启动失败: HTTP 服务器未能启动，请检查端口是否被占用", "error")
+        except Exception as e:
+            self.log(f"启动失败: {e}", "error")
+        finally:
+            # 被取消时 uvicorn 的 shutdown 钩子可能没有执行，这里确保 Claude 进程被停止、
+            # PTY 读事件从常驻事件循环上注销
+            if app is not None:
+                try:
+                    await app.state.stop_claude()
+                except Exception as e:
+                    self.log(f"停止 Claude 进程失败: {e}", "error")
+            self.is_running = False
+            # 主动停止时由 _on_service_stopped 统一更新界面
+            if not self._stopping:
+                self.root.after(0, lambda: self._update_ui_running(False))
 
     def _start_frp(self):
         """启动 FRP 隧道"""
@@ -464,14 +613,15 @@ class AgentGUI:
             self.log("正在启动 FRP 隧道...")
 
             # 检查/下载 frpc
-            frpc_path = download_frpc()
+            frp = _frp_module()
+            frpc_path = frp.download_frpc()
             if not frpc_path:
                 self.log("警告: 无法下载 frpc，仅使用本地访问", "error")
                 self.root.after(0, lambda: self.copy_url_btn.configure(text="复制本地地址"))
                 return
 
             # 创建 FRP 客户端
-            frp_client = FRPClient(
+            frp_client = frp.FRPClient(
                 server_addr=self.config.frp_server,
                 server_port=self.config.frp_port,
                 auth_token=self.config.frp_token,
@@ -482,9 +632,9 @@ class AgentGUI:
             # 启动 FRP
             if frp_client.start(frpc_path):
                 self.frp_client = frp_client  # 只在成功时保存
-                public_url = f"{self.frp_client.public_url}?token={self.access_token}"
+                self.remote_url = f"{self.frp_client.public_url}?token={self.access_token}"
                 self.log(f"  FRP 隧道已建立")
-                self.log(f"  远程地址: {public_url}", "highlight")
+                self.log(f"  远程地址: {self.remote_url}", "highlight")
                 self.root.after(0, lambda: self.copy_url_btn.configure(text="复制远程地址"))
 
                 # 保存 agent_id
@@ -501,8 +651,21 @@ class AgentGUI:
             self.root.after(0, lambda: self.copy_url_btn.configure(text="复制本地地址"))
 
     def _stop_service(self):
+        """停止服务：耗时的清理放到后台线程，界面保持响应"""
         self.log("正在停止服务...")
+        self._stopping = True
+        self.start_btn.configure(text="正在停止...", state="disabled")
 
+        def stop():
+            try:
+                self._shutdown()
+            finally:
+                self.root.after(0, self._on_service_stopped)
+
+        threading.Thread(target=stop, daemon=True).start()
+
+    def _shutdown(self):
+        """依次停止 FRP 隧道和 HTTP 服务器（在后台线程执行，可能阻塞数秒）"""
         # 1. 停止 FRP 隧道
         if self.frp_client:
             self.log("停止 FRP 隧道...")
@@ -511,63 +674,71 @@ class AgentGUI:
             except Exception as e:
                 self.log(f"FRP 停止异常: {e}", "warning")
             self.frp_client = None
+        self.remote_url = None
 
         # 2. 信号 uvicorn 停止（不要立即停止事件循环，让它有机会优雅关闭）
         if self.uvicorn_server:
             self.log("停止 HTTP 服务器...")
-            self.uvicorn_server.should_exit = True
-            # 注意：不要在这里设置 self.uvicorn_server = None，让线程自然结束
+            # 先通知 SSE 流自行结束，否则 uvicorn 要等宽限期满后强制取消这些连接
+            self.uvicorn_server.config.app.state.close_streams()
+            # 在服务器所在的事件循环线程里设置退出标志，同时唤醒该循环
+            self.loop.call_soon_threadsafe(
+                setattr, self.uvicorn_server, "should_exit", True
+            )
+            # 注意：不要在这里设置 self.uvicorn_server = None，让协程自然结束
 
-        # 3. 等待服务器线程自然结束（uvicorn 会处理 shutdown 事件）
-        if self.server_thread and self.server_thread.is_alive():
+        # 3. 等待服务器协程自然结束（uvicorn 会处理 shutdown 事件）
+        future = self._serve_future
+        if future and not future.done():
             self.log("等待服务器关闭...")
-            self.server_thread.join(timeout=5)
-            
-            # 如果5秒后还没结束，强制停止事件循环
-            if self.server_thread.is_alive():
-                self.log("服务器未能在5秒内关闭，强制停止...", "warning")
-                if self.loop and self.loop.is_running():
-                    self.loop.call_soon_threadsafe(self.loop.stop)
-                # 再等待一下
-                self.server_thread.join(timeout=2)
-
-        # 4. 清理事件循环
-        if self.loop:
             try:
-                if not self.loop.is_closed():
-                    self.loop.close()
+                future.result(timeout=SERVER_STOP_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                # 超时仍未结束则取消服务器协程，_serve 的 finally 会兜底停止 Claude 进程
+                self.log(f"服务器未能在{SERVER_STOP_TIMEOUT}秒内关闭，强制停止...", "warning")
+                future.cancel()
+                # 等待兜底清理完成（Claude 进程退出最长约 1 秒）
+                deadline = time.monotonic() + 2
+                while self.is_running and time.monotonic() < deadline:
+                    time.sleep(0.05)
             except Exception:
                 pass
-            self.loop = None
 
-        # 5. 清理状态
+    def _on_service_stopped(self):
+        """后台停止完成后在主线程清理状态"""
         self.uvicorn_server = None
-        self.server_thread = None
+        self._serve_future = None
         self.is_running = False
+        self._stopping = False
         self._update_ui_running(False)
         self.log("服务已完全停止")
+        if self._close_after_stop:
+            self.root.destroy()
 
     def _update_ui_running(self, running: bool):
+        # 启动/停止过程中按钮被临时禁用，总是需要恢复
+        self.start_btn.configure(state="normal", **self._start_btn_looks[running])
+        if running == self._ui_running:
+            return
+        self._ui_running = running
         if running:
-            self.start_btn.configure(text="停止服务", style='Stop.TButton', state="normal")
             self.status_label.configure(text="运行中", fg=COLORS['success'])
             self.copy_url_btn.configure(text="复制本地地址", state="normal")
         else:
-            self.start_btn.configure(text="启动服务", style='Accent.TButton', state="normal")
             self.status_label.configure(text="未运行", fg=COLORS['text_light'])
             self.copy_url_btn.configure(text="复制访问地址", state="disabled")
 
     def _copy_url(self):
-        if not self.is_running or not self.access_token:
+        if not self.is_running or not self.local_url:
             messagebox.showinfo("提示", "请先启动服务")
             return
 
         # 优先使用远程地址
-        if self.frp_client and self.frp_client.public_url:
-            url = f"{self.frp_client.public_url}?token={self.access_token}"
+        if self.remote_url:
+            url = self.remote_url
             url_type = "远程"
         else:
-            url = f"http://localhost:{self.config.local_port}?token={self.access_token}"
+            url = self.local_url
             url_type = "本地"
 
         self.root.clipboard_clear()
@@ -578,22 +749,62 @@ class AgentGUI:
         self.log_text.configure(state=tk.NORMAL)
         self.log_text.delete(1.0, tk.END)
         self.log_text.configure(state=tk.DISABLED)
+        self._log_lines = 0
 
     def log(self, message: str, level: str = "info"):
-        def _log():
-            self.log_text.configure(state=tk.NORMAL)
-            tag = 'info'
-            if any(w in message for w in ['ERROR', '失败', '错误']):
-                tag = 'error'
-            elif any(w in message for w in ['成功', '已启动', '已建立']):
-                tag = 'success'
-            elif 'token=' in message or '====' in message:
-                tag = 'highlight'
-            ts = datetime.now().strftime("%H:%M:%S")
-            self.log_text.insert(tk.END, f"[{ts}] {message}\n", tag)
+        ts = datetime.now().strftime("%H:%M:%S")
+        # 标签在调用方线程算好再入队，不碰 Tk，任何线程都可以安全调用
+        self._log_buf.append((f"[{ts}] {message}\n", _classify(message)))
+
+    def _pump_log(self):
+        """主线程定时把积累的日志一次性写入日志框，只刷新一次界面
+
+        有日志时按最短间隔刷新；连续空闲时间隔每次放大 1.5 倍，直到空闲上限。
+        """
+        busy = True
+        try:
+            busy = self._flush_log()
+        finally:
+            if busy:
+                self._pump_interval = LOG_FLUSH_INTERVAL
+            else:
+                self._pump_interval = min(int(self._pump_interval * 1.5), LOG_FLUSH_INTERVAL_IDLE)
+            self.root.after(self._pump_interval, self._pump_log)
+
+    def _flush_log(self) -> bool:
+        """写入积累的日志，返回本次是否有日志"""
+        # frpc 运行期间的输出（如断线重连）由其读取线程放入队列，这里一并取出
+        frp_client = self.frp_client
+        if frp_client:
+            while (line := frp_client.read_output()) is not None:
+                self.log(f"frpc: {line}")
+        # 相邻同标签的行合并成一段，减少传给 Tk 的参数个数
+        args = []
+        run_tag = None
+        run = []
+        while self._log_buf:
+            text, tag = self._log_buf.popleft()
+            self._log_lines += text.count("\n")
+            if tag != run_tag and run:
+                args += ("".join(run), run_tag)
+                run.clear()
+            run_tag = tag
+            run.append(text)
+        if not run:
+            return False
+        args += ("".join(run), run_tag)
+        # 用户向上翻看时不自动滚动到底部
+        at_bottom = self.log_text.yview()[1] >= 0.999
+        self.log_text.configure(state=tk.NORMAL)
+        self.log_text.insert(tk.END, *args)
+        if self._log_lines > LOG_MAX_LINES + LOG_TRIM_SLACK:
+            # 自己计数行数，不必每次向 Tk 查询
+            self.log_text.delete('1.0', f'{self._log_lines - LOG_MAX_LINES + 1}.0')
+            self._log_lines = LOG_MAX_LINES
+        if at_bottom:
             self.log_text.see(tk.END)
-            self.log_text.configure(state=tk.DISABLED)
-        self.root.after(0, _log)
+        self.log_text.configure(state=tk.DISABLED)
+        return True
 
     def run(self):
         # 设置日志处理器，将日志输出到 GUI
@@ -611,11 +822,19 @@ class AgentGUI:
 
         def on_closing():
             if self.is_running:
-                self._stop_service()
-            self.root.destroy()
+                # 先隐藏窗口，停止完成后再销毁，期间事件循环继续处理回调
+                self._close_after_stop = True
+                self.root.withdraw()
+                if not self._stopping:
+                    self._stop_service()
+            else:
+                self.root.destroy()
 
         self.root.protocol("WM_DELETE_WINDOW", on_closing)
         self.root.mainloop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        # 写入尚未落盘的延迟保存（内容未变时直接跳过）
+        self.config.save()
 
     def _setup_logging(self):
         """将 Python 日志重定向到 GUI"""
@@ -627,7 +846,7 @@ class AgentGUI:
 
             def emit(self, record):
                 msg = self.format(record)
-                self.gui.root.after(0, lambda: self.gui.log(msg))
+                self.gui.log(msg)
 
         handler = GUILogHandler(self)
         handler.setFormatter(logging.Formatter("%(message)s"))
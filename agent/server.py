@@ -12,14 +12,16 @@ Claude Code Remote - 本地 HTTP/SSE 服务器
 """
 
 import asyncio
+import codecs
+import gzip
 import json
 import logging
 import os
 import pty
 import secrets
-import select
 import signal
 import sys
+import zlib
 from pathlib import Path
 from typing import Optional
 
@@ -27,12 +29,81 @@ import uvicorn
 from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
 
+# 可选依赖：安装了 orjson 时用它解析请求体，否则用标准库
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 logger = logging.getLogger("claude-remote")
 
+# PTY 输出合并参数：单次读取大小、批次上限、空闲/持续输出时的刷新窗口（秒）
+PTY_READ_SIZE = 65536
+OUTPUT_BATCH_SIZE = 65536
+OUTPUT_IDLE_FLUSH = 0.002
+OUTPUT_MAX_FLUSH = 0.016
+
+# SSE 心跳使用协议自带的注释行，浏览器 EventSource 直接忽略，不触发 onmessage
+# 事件均预先编码为 bytes，StreamingResponse 无需再逐块编码
+HEARTBEAT_EVENT = b": heartbeat\n\n"
+
+# 输出使用具名事件 "o"，数据为 UTF-8 原文，只转义反斜杠和 CR/LF（SSE 的行分隔符）；
+# 相比 JSON 不会把 ESC、中文等字符展开成 \uXXXX，终端输出体积明显更小
+OUTPUT_EVENT_PREFIX = b"event: o\ndata: "
+OUTPUT_EVENT_SUFFIX = b"\n\n"
+
+# /input、/resize 的固定应答，预先编码，省去每次按键的 FastAPI 响应序列化
+STATUS_OK_BODY = b'{"status":"ok"}'
+
+# 客户端支持 gzip 时压缩 SSE 流（终端输出重复度高，手机网络下主要瓶颈是带宽）：
+# 整条连接共用一个压缩上下文，每个事件后同步刷新，不延迟输出；
+# 窗口 4KB（wbits 12）、memLevel 5，每个连接的压缩状态约 32KB
+SSE_GZIP_LEVEL = 6
+SSE_GZIP_WBITS = 16 + 12
+SSE_GZIP_MEMLEVEL = 5
+
+
+def encode_output(text: str) -> bytes:
+    """按输出事件的格式转义一批终端输出（前端 unescapeOutput 还原）"""
+    return text.replace("\\", "\\\\").replace("\r", "\\r").replace("\n", "\\n").encode("utf-8")
+
+
 # ============================================================================
 # Claude 进程管理
 # ============================================================================
 
+# 上次找到的 claude 路径，文件仍存在时直接复用
+_CLAUDE_PATH_CACHE: Optional[str] = None
+
+
+def find_claude() -> str:
+    """查找 claude 命令（结果缓存），找不到时抛出 FileNotFoundError"""
+    global _CLAUDE_PATH_CACHE
+    if _CLAUDE_PATH_CACHE and os.path.exists(_CLAUDE_PATH_CACHE):
+        return _CLAUDE_PATH_CACHE
+    import shutil
+    paths = [
+        Path.home() / ".local" / "bin" / "claude",
+        Path("/usr/local/bin/claude"),
+        Path("/opt/homebrew/bin/claude"),
+        Path.home() / ".npm-global" / "bin" / "claude",
+    ]
+    found = shutil.which("claude")
+    if not found:
+        for p in paths:
+            if p.exists() and os.access(p, os.X_OK):
+                found = str(p)
+                break
+    if not found:
+        raise FileNotFoundError(
+            "未找到 Claude Code CLI。\n"
+            "请先安装: npm install -g @anthropic-ai/claude-code"
+        )
+    _CLAUDE_PATH_CACHE = found
+    return found
+
+
 class ClaudeProcess:
     """管理 Claude Code CLI 进程"""
 
@@ -43,28 +114,23 @@ class ClaudeProcess:
         self.slave_fd: Optional[int] = None
         self.pid: Optional[int] = None
         self.output_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
-        self._reader_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reading = False
+        self._eof = False
+        self._read_buf = bytearray(PTY_READ_SIZE)
+        self._pending = bytearray()
+        self._pending_since = 0.0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._input_buf = bytearray()
+        self._input_scheduled = False
+        self._writing = False
+        # PTY 写入出错（子进程已退出）后不再尝试写入
+        self._input_failed = False
 
     @staticmethod
     def _find_claude() -> str:
         """查找 claude 命令"""
-        import shutil
-        paths = [
-            Path.home() / ".local" / "bin" / "claude",
-            Path("/usr/local/bin/claude"),
-            Path("/opt/homebrew/bin/claude"),
-            Path.home() / ".npm-global" / "bin" / "claude",
-        ]
-        found = shutil.which("claude")
-        if found:
-            return found
-        for p in paths:
-            if p.exists() and os.access(p, os.X_OK):
-                return str(p)
-        raise FileNotFoundError(
-            "未找到 Claude Code CLI。\n"
-            "请先安装: npm install -g @anthropic-ai/claude-code"
-        )
+        return find_claude()
 
     def start(self):
         """启动 Claude 进程"""
@@ -97,33 +163,141 @@ class ClaudeProcess:
             # 父进程
             os.close(self.slave_fd)
             self.slave_fd = None
+            # 非阻塞写入，大段粘贴时不会卡住事件循环
+            os.set_blocking(self.master_fd, False)
             logger.info(f"Claude 进程已启动 (PID: {self.pid})")
 
     async def start_reader(self):
-        """启动异步输出读取"""
-        self._reader_task = asyncio.create_task(self._read_output())
-
-    async def _read_output(self):
-        """持续读取 Claude 输出"""
-        loop = asyncio.get_event_loop()
-        while self.master_fd is not None:
+        """注册 PTY 读事件，有输出时由事件循环直接回调"""
+        self._loop = asyncio.get_running_loop()
+        self._resume_reading()
+
+    def _resume_reading(self):
+        if not self._reading and self.master_fd is not None:
+            self._loop.add_reader(self.master_fd, self._on_readable)
+            self._reading = True
+
+    def _pause_reading(self):
+        if self._reading:
+            self._loop.remove_reader(self.master_fd)
+            self._reading = False
+
+    def _on_readable(self):
+        """PTY 可读回调：读取数据并合并到待发送批次
+
+        空闲约 2ms 无新数据、持续输出满 16ms 或累计达到 64KB 时刷新。
+        fd 为非阻塞，一次回调内连续读取，直到暂无数据或凑满一批。
+        """
+        while len(self._pending) < OUTPUT_BATCH_SIZE:
             try:
-                ready = await loop.run_in_executor(
-                    None, lambda: select.select([self.master_fd], [], [], 0.1)
-                )
-                if ready[0]:
-                    data = os.read(self.master_fd, 4096)
-                    if not data:
-                        break
-                    await self.output_queue.put(data.decode("utf-8", errors="replace"))
-            except (OSError, ValueError):
+                # 读入预分配缓冲区，避免每次读取都分配新的 bytes 对象
+                n = os.readv(self.master_fd, [self._read_buf])
+            except BlockingIOError:
                 break
-        logger.info("Claude 输出读取结束")
+            except OSError:
+                # 子进程退出后 PTY 读取报错 (EIO)
+                n = 0
+            if not n:
+                self._eof = True
+                self._pause_reading()
+                self._flush_output()
+                logger.info("Claude 输出读取结束")
+                return
+            if not self._pending:
+                self._pending_since = self._loop.time()
+            self._pending += memoryview(self._read_buf)[:n]
+
+        if not self._pending:
+            return
+        now = self._loop.time()
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        remaining = self._pending_since + OUTPUT_MAX_FLUSH - now
+        if len(self._pending) >= OUTPUT_BATCH_SIZE or remaining <= 0:
+            self._flush_output()
+        else:
+            self._flush_handle = self._loop.call_later(
+                min(OUTPUT_IDLE_FLUSH, remaining), self._flush_output
+            )
+
+    def _flush_output(self):
+        """将待发送批次放入输出队列，队列满时暂停读取形成背压"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        try:
+            self.output_queue.put_nowait(bytes(self._pending))
+        except asyncio.QueueFull:
+            self._pause_reading()
+            return
+        self._pending.clear()
+
+    async def read_output(self) -> bytes:
+        """获取一批输出，必要时恢复被背压暂停的读取
+
+        队列中已积压的批次一并取出合并（不超过 OUTPUT_BATCH_SIZE），
+        减少客户端处理慢时的事件数和任务切换。
+        """
+        data = await self.output_queue.get()
+        if len(data) < OUTPUT_BATCH_SIZE and not self.output_queue.empty():
+            parts = [data]
+            size = len(data)
+            while size < OUTPUT_BATCH_SIZE:
+                try:
+                    chunk = self.output_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                parts.append(chunk)
+                size += len(chunk)
+            data = b"".join(parts)
+        if self._pending:
+            self._flush_output()
+        if not (self._pending or self._eof):
+            self._resume_reading()
+        return data
 
     def write_input(self, data: str):
-        """写入输入到 Claude"""
-        if self.master_fd is not None:
-            os.write(self.master_fd, data.encode("utf-8"))
+        """写入输入到 Claude
+
+        同一轮事件循环内到达的多次输入合并为一次 os.write。
+        """
+        if self.master_fd is None or self._input_failed:
+            return
+        self._input_buf += data.encode("utf-8")
+        if not (self._input_scheduled or self._writing):
+            self._input_scheduled = True
+            self._loop.call_soon(self._flush_input)
+
+    def _flush_input(self):
+        """写出待发送的输入，写不完时等 PTY 可写再继续"""
+        self._input_scheduled = False
+        if self.master_fd is None:
+            self._input_buf.clear()
+            return
+        try:
+            n = os.write(self.master_fd, self._input_buf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            # 子进程退出后 PTY 写入报错 (EIO/EBADF)：丢弃待写输入并注销写事件，只记录一次
+            logger.warning(f"写入 Claude 输入失败，后续输入将被丢弃: {e}")
+            self._input_failed = True
+            self._input_buf.clear()
+            if self._writing:
+                self._loop.remove_writer(self.master_fd)
+                self._writing = False
+            return
+        del self._input_buf[:n]
+
+        if self._input_buf and not self._writing:
+            self._loop.add_writer(self.master_fd, self._flush_input)
+            self._writing = True
+        elif not self._input_buf and self._writing:
+            self._loop.remove_writer(self.master_fd)
+            self._writing = False
 
     def resize(self, rows: int, cols: int):
         """调整终端大小"""
@@ -137,13 +311,34 @@ class ClaudeProcess:
     def stop(self):
         """停止 Claude 进程"""
         logger.info("正在停止 Claude 进程...")
+        self._close_pty()
+        self._terminate()
+        self._drain_queue()
+        logger.info("Claude 进程已停止")
+
+    async def stop_async(self):
+        """在事件循环中停止 Claude 进程
+
+        等待子进程退出最长约 1 秒，这部分放到线程池执行，不阻塞其他连接。
+        """
+        logger.info("正在停止 Claude 进程...")
+        self._close_pty()
+        await asyncio.get_running_loop().run_in_executor(None, self._terminate)
+        self._drain_queue()
+        logger.info("Claude 进程已停止")
 
-        # 1. 取消读取任务
-        if self._reader_task:
-            self._reader_task.cancel()
-            self._reader_task = None
+    def _close_pty(self):
+        """注销 PTY 读事件并关闭主端（需在事件循环线程调用）"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pause_reading()
+        self._pending.clear()
+        if self._writing:
+            self._loop.remove_writer(self.master_fd)
+            self._writing = False
+        self._input_buf.clear()
 
-        # 2. 关闭 PTY 主端
         if self.master_fd is not None:
             try:
                 os.close(self.master_fd)
@@ -152,7 +347,8 @@ class ClaudeProcess:
                 logger.debug(f"关闭 PTY 主端失败: {e}")
             self.master_fd = None
 
-        # 3. 终止 Claude 子进程
+    def _terminate(self):
+        """终止 Claude 子进程并回收（阻塞）"""
         if self.pid:
             try:
                 # 先尝试优雅终止
@@ -176,7 +372,8 @@ class ClaudeProcess:
                 logger.debug(f"终止 Claude 进程时出错: {e}")
             self.pid = None
 
-        # 4. 清空输出队列
+    def _drain_queue(self):
+        """清空输出队列"""
         queue_count = 0
         while not self.output_queue.empty():
             try:
@@ -187,8 +384,6 @@ class ClaudeProcess:
         if queue_count > 0:
             logger.debug(f"已清空输出队列 ({queue_count} 条)")
 
-        logger.info("Claude 进程已停止")
-
 
 # ============================================================================
 # HTTP/SSE 服务器
@@ -208,12 +403,17 @@ def create_app(
     # 连接计数和活跃 SSE 任务追踪
     connection_count = {"sse": 0, "total": 0}
     active_sse_tasks: set = set()  # 追踪活跃的 SSE 生成器任务
+    # 服务即将退出时置位，让 SSE 生成器自行结束，不必等 uvicorn 宽限期满后强制取消
+    streams_closing: Optional[asyncio.Event] = None
+    server_loop: Optional[asyncio.AbstractEventLoop] = None
 
     # 加载终端 HTML
     html_path = Path(__file__).parent / "terminal.html"
     terminal_html = ""
     if html_path.exists():
         terminal_html = html_path.read_text(encoding="utf-8")
+    # 页面内容固定，启动时压缩一次，支持 gzip 的客户端直接取用
+    terminal_html_gz = gzip.compress(terminal_html.encode("utf-8"), 9, mtime=0)
 
     # --- 认证中间件 ---
     @app.middleware("http")
@@ -244,7 +444,9 @@ def create_app(
     # --- 启动/关闭 ---
     @app.on_event("startup")
     async def startup():
-        nonlocal claude
+        nonlocal claude, streams_closing, server_loop
+        server_loop = asyncio.get_running_loop()
+        streams_closing = asyncio.Event()
         claude = ClaudeProcess(workspace, claude_path)
         claude.start()
         await claude.start_reader()
@@ -257,32 +459,49 @@ def create_app(
         # 1. 取消所有活跃的 SSE 连接
         if active_sse_tasks:
             logger.info(f"取消 {len(active_sse_tasks)} 个活跃 SSE 连接")
-            for task in list(active_sse_tasks):
+            tasks = list(active_sse_tasks)
+            for task in tasks:
                 task.cancel()
-            # 等待所有任务完成取消
-            await asyncio.gather(*active_sse_tasks, return_exceptions=True)
+            # 等待所有任务完成取消，设置上限避免个别连接拖住关闭流程
+            _, pending = await asyncio.wait(tasks, timeout=5)
+            if pending:
+                logger.warning(f"{len(pending)} 个 SSE 连接未能在5秒内结束")
             active_sse_tasks.clear()
 
         # 2. 停止 Claude 进程
-        if claude:
-            logger.info("停止 Claude 进程...")
-            claude.stop()
-            # 清空输出队列
-            while not claude.output_queue.empty():
-                try:
-                    claude.output_queue.get_nowait()
-                except asyncio.QueueEmpty:
-                    break
+        await stop_claude()
 
         logger.info("服务已关闭")
 
+    def close_streams():
+        """通知所有 SSE 流结束（可在任意线程或信号处理函数中调用）"""
+        if server_loop and streams_closing:
+            server_loop.call_soon_threadsafe(streams_closing.set)
+
+    async def stop_claude():
+        """停止 Claude 进程，可重复调用
+
+        宿主（如 GUI）取消服务协程时 shutdown 可能来不及执行，需要调用它兜底清理。
+        """
+        nonlocal claude
+        if claude:
+            process, claude = claude, None
+            logger.info("停止 Claude 进程...")
+            await process.stop_async()
+
     # --- 路由 ---
     @app.get("/", response_class=HTMLResponse)
     async def index(request: Request):
         connection_count["total"] += 1
         client = request.client.host if request.client else "unknown"
         logger.info(f"[访问] 终端页面 - 来源: {client} (累计访问: {connection_count['total']})")
-        return terminal_html
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            return Response(
+                terminal_html_gz,
+                media_type="text/html; charset=utf-8",
+                headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+            )
+        return HTMLResponse(terminal_html, headers={"Vary": "Accept-Encoding"})
 
     @app.get("/sse")
     async def sse_stream(request: Request):
@@ -292,88 +511,138 @@ def create_app(
         conn_id = connection_count["sse"]
         logger.info(f"[SSE #{conn_id}] 连接建立 - 来源: {client}")
 
-        # 用于追踪当前连接
-        current_task = asyncio.current_task()
-        if current_task:
-            active_sse_tasks.add(current_task)
+        use_gzip = "gzip" in request.headers.get("accept-encoding", "")
 
         async def generate():
+            # 追踪实际执行流式输出的任务（不同 ASGI 版本下可能不是路由处理任务）
+            current_task = asyncio.current_task()
+            if current_task:
+                active_sse_tasks.add(current_task)
+            # 增量解码：跨批次截断的 UTF-8 多字节字符留到下一批拼接
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            if use_gzip:
+                compressor = zlib.compressobj(
+                    SSE_GZIP_LEVEL, zlib.DEFLATED, SSE_GZIP_WBITS, SSE_GZIP_MEMLEVEL
+                )
+
+                def frame(event: bytes) -> bytes:
+                    return compressor.compress(event) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                def frame(event: bytes) -> bytes:
+                    return event
+            closing = asyncio.ensure_future(streams_closing.wait())
+            read = None
             try:
-                while True:
-                    try:
-                        output = await asyncio.wait_for(
-                            claude.output_queue.get(), timeout=30
+                while not streams_closing.is_set():
+                    if claude.output_queue.empty():
+                        # 空闲时等待输出，同时响应服务退出，30 秒无输出发心跳
+                        read = asyncio.ensure_future(claude.read_output())
+                        done, _ = await asyncio.wait(
+                            (read, closing), timeout=30,
+                            return_when=asyncio.FIRST_COMPLETED,
                         )
-                        yield f"data: {json.dumps({'type': 'output', 'data': output})}\n\n"
-                    except asyncio.TimeoutError:
-                        # 心跳保持连接
-                        yield f"data: {json.dumps({'type': 'heartbeat'})}\n\n"
+                        if read not in done:
+                            read.cancel()
+                            read = None
+                            if closing in done:
+                                break
+                            # 心跳保持连接
+                            yield frame(HEARTBEAT_EVENT)
+                            continue
+                        chunk = read.result()
+                        read = None
+                    else:
+                        # 已有数据时直接取，省去为每批输出创建等待任务
+                        chunk = await claude.read_output()
+                    output = decoder.decode(chunk)
+                    if not output:
+                        continue
+                    yield frame(b"".join((
+                        OUTPUT_EVENT_PREFIX,
+                        encode_output(output),
+                        OUTPUT_EVENT_SUFFIX,
+                    )))
+                logger.info(f"[SSE #{conn_id}] 服务退出，结束连接 - 来源: {client}")
             except asyncio.CancelledError:
                 logger.info(f"[SSE #{conn_id}] 连接被取消 - 来源: {client}")
                 raise
             except Exception as e:
                 logger.info(f"[SSE #{conn_id}] 连接异常断开 - 来源: {client}, 原因: {e}")
             finally:
+                closing.cancel()
+                if read:
+                    read.cancel()
                 # 从活跃连接中移除
-                if current_task and current_task in active_sse_tasks:
+                if current_task:
                     active_sse_tasks.discard(current_task)
                 logger.info(f"[SSE #{conn_id}] 连接关闭 - 来源: {client}")
 
+        headers = {
+            "Cache-Control": "no-cache, no-store, must-revalidate",
+            "Pragma": "no-cache",
+            "Expires": "0",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",  # Nginx 禁用缓冲
+            "Vary": "Accept-Encoding",
+        }
+        if use_gzip:
+            headers["Content-Encoding"] = "gzip"
         return StreamingResponse(
             generate(),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Pragma": "no-cache",
-                "Expires": "0",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",  # Nginx 禁用缓冲
-            },
+            headers=headers,
         )
 
     @app.post("/input")
     async def receive_input(request: Request):
-        """接收键盘输入"""
-        body = await request.json()
-        data = body.get("data", "")
+        """接收键盘输入
+
+        请求体为纯文本时直接作为输入；JSON 格式 {"data": ...} 仍然兼容。
+        """
+        if request.headers.get("content-type", "").startswith("application/json"):
+            body = json_loads(await request.body())
+            data = body.get("data", "")
+        else:
+            data = (await request.body()).decode("utf-8", errors="replace")
         if data and claude:
-            # 日志记录输入（敏感信息用星号替代）
-            display_data = data
-            if len(data) > 20:
-                display_data = data[:10] + "..." + f"({len(data)}字符)"
-            elif data in ['\r', '\n', '\r\n']:
-                display_data = "[Enter]"
-            elif data == '\t':
-                display_data = "[Tab]"
-            elif data == '\x03':
-                display_data = "[Ctrl+C]"
-            elif data == '\x04':
-                display_data = "[Ctrl+D]"
-            elif data == '\x1a':
-                display_data = "[Ctrl+Z]"
-            elif data == '\x1b':
-                display_data = "[Esc]"
-            elif data.startswith('\x1b['):
-                display_data = f"[方向键]"
-            elif not data.isprintable():
-                display_data = f"[控制符 0x{ord(data[0]):02x}]"
-            
-            client = request.client.host if request.client else "unknown"
-            logger.debug(f"[输入] {display_data} - 来源: {client}")
+            # 日志记录输入（敏感信息用星号替代）；摘要只用于调试日志，未开启 DEBUG 时整段跳过
+            if logger.isEnabledFor(logging.DEBUG):
+                display_data = data
+                if len(data) > 20:
+                    display_data = data[:10] + "..." + f"({len(data)}字符)"
+                elif data in ['\r', '\n', '\r\n']:
+                    display_data = "[Enter]"
+                elif data == '\t':
+                    display_data = "[Tab]"
+                elif data == '\x03':
+                    display_data = "[Ctrl+C]"
+                elif data == '\x04':
+                    display_data = "[Ctrl+D]"
+                elif data == '\x1a':
+                    display_data = "[Ctrl+Z]"
+                elif data == '\x1b':
+                    display_data = "[Esc]"
+                elif data.startswith('\x1b['):
+                    display_data = f"[方向键]"
+                elif not data.isprintable():
+                    display_data = f"[控制符 0x{ord(data[0]):02x}]"
+
+                client = request.client.host if request.client else "unknown"
+                logger.debug(f"[输入] {display_data} - 来源: {client}")
             claude.write_input(data)
-        return {"status": "ok"}
+        return Response(STATUS_OK_BODY, media_type="application/json")
 
     @app.post("/resize")
     async def resize_terminal(request: Request):
         """调整终端尺寸"""
-        body = await request.json()
+        body = json_loads(await request.body())
         rows = body.get("rows", 40)
         cols = body.get("cols", 120)
         if claude:
             client = request.client.host if request.client else "unknown"
             logger.debug(f"[调整] 终端尺寸 {cols}x{rows} - 来源: {client}")
             claude.resize(rows, cols)
-        return {"status": "ok"}
+        return Response(STATUS_OK_BODY, media_type="application/json")
 
     @app.get("/health")
     async def health():
@@ -384,7 +653,21 @@ def create_app(
             "sse_connections": connection_count["sse"],
         }
 
-    # 保存 token 供外部使用
+    # 保存 token 和清理入口供外部使用
     app.state.access_token = token
+    app.state.stop_claude = stop_claude
+    app.state.close_streams = close_streams
 
     return app
+
+
+class RemoteServer(uvicorn.Server):
+    """收到退出信号时先让 SSE 长连接自行结束的 uvicorn 服务器
+
+    SSE 流不会自己结束，直接退出时 uvicorn 要等满 timeout_graceful_shutdown
+    再强制取消请求，并打印取消引发的异常堆栈。
+    """
+
+    def handle_exit(self, sig, frame):
+        self.config.app.state.close_streams()
+        super().handle_exit(sig, frame)